@@ -14,13 +14,13 @@ Pass interface name as sole argument
 """
 
 from sys import argv
-import socket
 
 from genl.nl80211 import (nl80211_schema,
                           NL80211_CMD_GET_INTERFACE, NL80211_CMD_GET_WIPHY)
 from genl import lookup_genl_family, if_nametoindex
 from genl.netlink import (get_genl_message, parse_genl_message,
-                          NETLINK_GENERIC, NLM_F_REQUEST)
+                          recv_nl_response, make_netlink_socket,
+                          NLM_F_REQUEST)
 
 
 # We need to look up the family ID which will go in the nl header's type
@@ -42,14 +42,13 @@ def do_nl80211_query(sock, cmd, **kwargs):
         payload=nl80211_schema.build(**kwargs))
     sock.send(msg)
 
-    msg = sock.recv(8192)
+    [msg] = recv_nl_response(sock)
     nl_header, genl_header, payload = parse_genl_message(msg)
     return nl80211_schema.parse(payload)
 
 
 def main():
-    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_GENERIC)
-    sock.bind((0, 0))
+    sock = make_netlink_socket()
 
     # Use GET_INTERFACE to get some basic info and the wiphy index
     iface_info = do_nl80211_query(sock, NL80211_CMD_GET_INTERFACE,
@@ -62,7 +61,7 @@ def main():
     print("Interface name: '{}' | MAC: {} | Current SSID: '{}'".format(
         iface_info.ifname,
         # Mac address is just bytes, up to us to pretty-print it
-        ":".join("{:02x}".format(b) for b in iface_info.mac),
+        iface_info.mac.hex(":"),
         iface_info.ssid))
 
     # As an example to illustrate that commands can nest, let's dump all the
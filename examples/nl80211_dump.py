@@ -10,12 +10,12 @@ Pass interface name as sole argument
 """
 
 from sys import argv
-import socket
 
 from genl.nl80211 import nl80211_schema, NL80211_CMD_GET_INTERFACE
 from genl import lookup_genl_family, if_nametoindex
 from genl.netlink import (get_genl_message, parse_genl_message,
-                          NETLINK_GENERIC, NLM_F_REQUEST)
+                          recv_nl_response, make_netlink_socket,
+                          NLM_F_REQUEST)
 
 
 def main():
@@ -24,8 +24,7 @@ def main():
     # broadcast groups exposed by the family.
     family = lookup_genl_family("nl80211")
 
-    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_GENERIC)
-    sock.bind((0, 0))
+    sock = make_netlink_socket()
 
     # We use get_genl_message to build a Generic Netlink message. The nl80211
     # command goes in the cmd field of the genl header.
@@ -41,9 +40,8 @@ def main():
         payload=nl80211_schema.build(ifindex=if_nametoindex(argv[1])))
     sock.send(msg)
 
-    # Note the fixed size receive. This library lacks support for multi-part
-    # messages.
-    msg = sock.recv(8192)
+    # The reply to a non-dump command is a single message.
+    [msg] = recv_nl_response(sock)
     # Parse out the nl and genl header
     nl_header, genl_header, payload = parse_genl_message(msg)
     # Now we use the same canned schema to parse then attributes in the reply
@@ -66,7 +64,7 @@ def main():
     # So instead of info["NL80211_ATTR_SSID"] we can just access info.ssid.
     print("\nname: '{}' | MAC: {} | Current SSID: '{}'".format(
         info.ifname,
-        ":".join("{:02x}".format(b) for b in info.mac),
+        info.mac.hex(":"),
         info.ssid))
 
 if __name__ == "__main__":
@@ -11,7 +11,8 @@ with the parameters provided as JSON objects, and the results printed as JSON
 objects.
 
 The keys in the JSON objects will be the full names of the attribute types (for
-example "NL80211_ATTR_INTERFACE".
+example "NL80211_ATTR_INTERFACE". Byte blob attributes are represented as
+base64 strings, both in the output and in the params.
 
 The schema in the library is incomplete, so depending on your system and the
 command you run, you will probably get warnings about unknown attributes
@@ -21,16 +22,18 @@ Try a command like this:
 pipenv run nl80211_json.py NL80211_CMD_GET_WIPHY '{"NL80211_ATTR_WIPHY": 0}'
 """
 
+import base64
 import json
 from argparse import ArgumentParser
-import socket
 from collections.abc import Mapping
 
 from genl.nl80211 import nl80211_schema, nl80211_constants
+from genl.nlattr import NlAttrSchema, NlAttrSchemaBytes, NlAttrSchemaList
 from genl.netlink import (parse_nl_message, parse_nl_error,
-                          get_genl_message, parse_genl_message,
+                          get_genl_message, parse_genl_body,
                           NLMSG_ERROR,
-                          NETLINK_GENERIC, NLM_F_REQUEST)
+                          recv_nl_response, make_netlink_socket,
+                          NLM_F_REQUEST)
 from genl import lookup_genl_family
 
 # The default JSON encoder doesn't fully convert things to dicts automatically,
@@ -40,11 +43,23 @@ class MyJsonEncoder(json.JSONEncoder):
         if isinstance(o, Mapping):
             return dict(o)
         if isinstance(o, bytes):
-            # Will this actually deserialise cleanly all the time? Not sure.
-            return "".join(r"\x{:02x}".format(b) for b in o)
+            return base64.b64encode(o).decode("ascii")
         return super().default(o)
 
 
+def decode_params(params, schema=nl80211_schema):
+    """Convert base64 strings in params back to bytes, where appropriate"""
+    if isinstance(schema, NlAttrSchemaBytes):
+        return base64.b64decode(params)
+    if isinstance(schema, NlAttrSchemaList):
+        return [decode_params(p, schema.subelem_schema) for p in params]
+    if isinstance(schema, NlAttrSchema):
+        return {name: decode_params(val,
+                                    schema.subattr_schemata.get(name))
+                for name, val in params.items()}
+    return params
+
+
 def main():
     parser = ArgumentParser(description=__doc__)
     parser.add_argument("command", help="Name of nl80211 command to call")
@@ -54,23 +69,22 @@ def main():
 
     family = lookup_genl_family("nl80211")
 
-    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_GENERIC)
-    sock.bind((0, 0))
+    sock = make_netlink_socket()
 
     msg = get_genl_message(
         mtype=family.id,
         flags=NLM_F_REQUEST,
         cmd=nl80211_constants[args.command],
-        payload=nl80211_schema.build(json.loads(args.params)))
+        payload=nl80211_schema.build(decode_params(json.loads(args.params))))
     sock.send(msg)
 
-    msg = sock.recv(8192)
+    [msg] = recv_nl_response(sock)
     nl_header, nl_payload = parse_nl_message(msg)
     if nl_header.mtype == NLMSG_ERROR:
         raise RuntimeError("Error {} from command"
                            .format(parse_nl_error(nl_payload)))
 
-    nl_header, genl_header, payload = parse_genl_message(msg)
+    genl_header, payload = parse_genl_body(nl_payload)
     print(json.dumps(nl80211_schema.parse(payload),
                      cls=MyJsonEncoder, indent=4))
 
@@ -4,34 +4,47 @@
 import ctypes
 import ctypes.util
 from collections import namedtuple
-import socket
+import functools
 import os
 import errno
+from types import MappingProxyType
 
 from .nlattr import NlAttrSchema
 from .netlink import (NLM_F_REQUEST,
                       GENL_ID_CTRL, GNL_FAMILY_VERSION,
-                      NETLINK_GENERIC,
                       NetlinkError,
                       get_genl_message,
-                      parse_genl_message)
+                      make_netlink_socket,
+                      parse_genl_message,
+                      recv_nl_response)
 
 
 # From linux/genetlink.h
-CTRL_CMD_GETFAMILY = None  # To relax the linter
+CTRL_CMD_GETFAMILY = 3
+
+CTRL_ATTR_FAMILY_ID = 1
+CTRL_ATTR_FAMILY_NAME = 2
+CTRL_ATTR_VERSION = 3
+CTRL_ATTR_HDRSIZE = 4
+CTRL_ATTR_MAXATTR = 5
+CTRL_ATTR_OPS = 6
+CTRL_ATTR_MCAST_GROUPS = 7
+
+CTRL_ATTR_MCAST_GRP_NAME = 1
+CTRL_ATTR_MCAST_GRP_ID = 2
+
 genl_ctrl_constants = {
-    "CTRL_CMD_GETFAMILY": 3,
-    "CTRL_ATTR_FAMILY_ID": 1,
-    "CTRL_ATTR_FAMILY_NAME": 2,
-    "CTRL_ATTR_MCAST_GROUPS": 7,
-    "CTRL_ATTR_MCAST_GRP_NAME": 1,
-    "CTRL_ATTR_VERSION": 3,
-    "CTRL_ATTR_HDRSIZE": 4,
-    "CTRL_ATTR_MAXATTR": 5,
-    "CTRL_ATTR_OPS": 6,
-    "CTRL_ATTR_MCAST_GRP_ID": 2,
+    "CTRL_CMD_GETFAMILY": CTRL_CMD_GETFAMILY,
+    "CTRL_ATTR_FAMILY_ID": CTRL_ATTR_FAMILY_ID,
+    "CTRL_ATTR_FAMILY_NAME": CTRL_ATTR_FAMILY_NAME,
+    "CTRL_ATTR_MCAST_GROUPS": CTRL_ATTR_MCAST_GROUPS,
+    "CTRL_ATTR_MCAST_GRP_NAME": CTRL_ATTR_MCAST_GRP_NAME,
+    "CTRL_ATTR_VERSION": CTRL_ATTR_VERSION,
+    "CTRL_ATTR_HDRSIZE": CTRL_ATTR_HDRSIZE,
+    "CTRL_ATTR_MAXATTR": CTRL_ATTR_MAXATTR,
+    "CTRL_ATTR_OPS": CTRL_ATTR_OPS,
+    "CTRL_ATTR_MCAST_GRP_ID": CTRL_ATTR_MCAST_GRP_ID,
 }
-globals().update(genl_ctrl_constants)
 
 
 # We'll need to use the GETFAMILY command, which is part of the core generic
@@ -83,12 +96,18 @@ getfamily_schema = NlAttrSchema.from_spec(getfamily_spec, genl_ctrl_constants)
 GenlFamilyInfo = namedtuple("GenlFamilyInfo", ["id", "mcast_groups"])
 
 
+@functools.lru_cache(maxsize=32)
 def lookup_genl_family(family_name):
     """
     Look up a generic netlink family by name
 
     Returns a GenlFamilyInfo with the numerical family ID and the IDs of the
-    multicast groups it exposes
+    multicast groups it exposes.
+
+    Family IDs don't change while the family is registered, so results are
+    cached; the same (read-only) GenlFamilyInfo is returned for repeated
+    lookups. Call ``lookup_genl_family.cache_clear()`` if a family might have
+    been re-registered, e.g. because its kernel module was reloaded.
     """
     cmd = get_genl_message(
         mtype=GENL_ID_CTRL,
@@ -97,17 +116,17 @@ def lookup_genl_family(family_name):
         version=GNL_FAMILY_VERSION,
         payload=getfamily_schema.build(family_name=family_name))
 
-    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_GENERIC)
+    sock = make_netlink_socket()
     try:
-        sock.bind((0, 0))
         sock.sendall(cmd)
-        data = sock.recv(4096)
+        [data] = recv_nl_response(sock)
         nl_header, genl_header, genl_body = parse_genl_message(data)
         response = getfamily_schema.parse(genl_body)
 
-        mcast_groups = {}
-        for entry in response.mcast_groups:
-            mcast_groups[entry.name.strip()] = entry.id
+        # This is only run on a cache miss; the resulting GenlFamilyInfo is
+        # shared by all later lookups of the family, hence read-only.
+        mcast_groups = MappingProxyType(
+            {entry.name: entry.id for entry in response.mcast_groups})
 
         return GenlFamilyInfo(response.family_id, mcast_groups)
     finally:
@@ -128,6 +147,9 @@ _if_indextoname.restype = ctypes.c_char_p
 IF_NAMESIZE = 16
 
 
+# Interface indexes only change on hotplug, so the lookups below are cached.
+# Use refresh_if_cache if interfaces may have been added or removed.
+@functools.lru_cache(maxsize=32)
 def if_nametoindex(name):
     index = _if_nametoindex(name.encode("ascii"))
 
@@ -141,6 +163,7 @@ def if_nametoindex(name):
     return index
 
 
+@functools.lru_cache(maxsize=32)
 def if_indextoname(index):
     name = _if_indextoname(index, b" " * IF_NAMESIZE)
 
@@ -152,3 +175,9 @@ def if_indextoname(index):
             raise OSError(op_errno, os.strerror(op_errno))
 
     return name.decode("ascii")
+
+
+def refresh_if_cache():
+    """Forget cached interface names and indexes"""
+    if_nametoindex.cache_clear()
+    if_indextoname.cache_clear()
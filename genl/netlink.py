@@ -6,9 +6,12 @@ Helpers and constants for netlink operations
 """
 
 import errno
+import itertools
 import os
+import socket
 import struct
 import time
+import warnings
 
 from collections import namedtuple
 
@@ -18,24 +21,49 @@ NETLINK_GENERIC = 16
 SOL_NETLINK = 270
 NETLINK_ADD_MEMBERSHIP = 1
 
+# Socket buffer sizes. The receive buffer for batch_recv_nl is big enough for
+# any single datagram the kernel sends in a dump; SO_RCVBUF and SO_SNDBUF are
+# raised so that the kernel doesn't drop messages while a burst of them is
+# being processed.
+NL_RECV_BUFSIZE = 65536
+NL_SOCKET_BUFSIZE = 1 << 20
+
 # Netlink flags
 NLM_F_REQUEST = 1
+NLM_F_MULTI = 2
 NLM_F_ACK = 4
 
 # Netlink message types
 NLMSG_ERROR = 0x02
+NLMSG_DONE = 0x03
 GENL_ID_CTRL = 0x10
 
 # Generic netlink protocol versions
 GNL_FAMILY_VERSION = 1
 NL80211_VERSION = 1
 
-# structs
-NL_HEADER_FMT = "@IHHII"
-NL_HEADER_LEN = struct.calcsize(NL_HEADER_FMT)
+# structs. Netlink uses host byte order, and the fields of these headers are
+# laid out so that there's never any padding between them, so "=" (native
+# order, standard sizes, no alignment) is the right spec for the wire format.
+NL_HEADER_FMT = "=IHHII"
+_NL_HDR_S = struct.Struct(NL_HEADER_FMT)
+NL_HEADER_LEN = _NL_HDR_S.size
+
+GNL_HEADER_FMT = "=BBH"
+_GNL_HDR_S = struct.Struct(GNL_HEADER_FMT)
+GNL_HEADER_LEN = _GNL_HDR_S.size
+
+# Both headers together, as they appear at the start of a genl message. This
+# relies on the netlink header already being 4-byte aligned, so there's no
+# padding between the two.
+assert NL_HEADER_LEN % 4 == 0
+_NL_GNL_HDR_S = struct.Struct(NL_HEADER_FMT + GNL_HEADER_FMT[1:])
 
-GNL_HEADER_FMT = "@BBH"
-GNL_HEADER_LEN = struct.calcsize(GNL_HEADER_FMT)
+NLA_HDR_FMT = "=HH"
+_NLA_HDR_S = struct.Struct(NLA_HDR_FMT)
+NLA_HDR_LEN = _NLA_HDR_S.size
+
+_ERR_S = struct.Struct("=i")
 
 NLMessageHeader = namedtuple(
     "NLMessage", ['length', 'mtype', 'flags', 'seq', 'port'])
@@ -53,86 +81,244 @@ class NetlinkError(Exception):
 
 
 def align(size):
-    # The 1 << 64 -1 is because python ints don't expose two's complement
-    return (size + 0x03) & (((1 << 64) - 1) - 3)
+    return (size + 3) & ~3
+
+
+_ALIGNED_NL_HDR_LEN = align(NL_HEADER_LEN)
+_ALIGNED_GNL_HDR_LEN = align(GNL_HEADER_LEN)
+_ALIGNED_NLA_HDR_LEN = align(NLA_HDR_LEN)
 
 
 def pad(data):
-    padding_len = align(len(data)) - len(data)
+    padding_len = -len(data) & 3
+    if not padding_len:
+        return data
     return data + (b'\0' * padding_len)
 
 
+# Defaults for the sequence number and port ID fields of outgoing messages.
+# Sequence numbers just need to be distinct, so count up from the time of
+# import rather than reading the clock for every message.
+_seq_counter = itertools.count(int(time.time()) & 0xFFFFFFFF)
+_PID = os.getpid()
+
+
 def get_genl_message(payload=None, mtype=0, cmd=0, version=0, flags=0,
                      seq=None, port=None):
-    length = NL_HEADER_LEN + GNL_HEADER_LEN + len(payload)
+    length = _NL_GNL_HDR_S.size + len(payload)
     padded_length = align(length)
-    padding = b'\0' * (padded_length - length)
 
-    nl_header = NLMessageHeader(
-        length=padded_length,
-        mtype=mtype,
-        flags=flags,
-        seq=seq or int(time.time()),
-        port=port or os.getpid())
+    # The buffer starts zeroed, so the trailing padding comes for free.
+    buf = bytearray(padded_length)
+    _NL_GNL_HDR_S.pack_into(buf, 0,
+                            padded_length, mtype, flags,
+                            (seq if seq is not None
+                             else next(_seq_counter) & 0xFFFFFFFF),
+                            port if port is not None else _PID,
+                            cmd, version, 0)
+    buf[_NL_GNL_HDR_S.size:length] = payload
 
-    genl_header = GNLMessageHeader(cmd=cmd, version=version, reserved=0)
-
-    return (struct.pack(NL_HEADER_FMT, *nl_header) +
-            struct.pack(GNL_HEADER_FMT, *genl_header) +
-            payload + padding)
+    return bytes(buf)
 
 
 def parse_nl_message(nl_message):
-    header_bytes = nl_message[:NL_HEADER_LEN]
+    # Work on a memoryview so that slicing out the body (and, further down,
+    # the attributes) doesn't copy the message.
+    nl_message = memoryview(nl_message)
 
-    nl_header = NLMessageHeader(*struct.unpack(NL_HEADER_FMT, header_bytes))
-    nl_body = nl_message[align(NL_HEADER_LEN):]
+    nl_header = NLMessageHeader(*_NL_HDR_S.unpack_from(nl_message, 0))
+    nl_body = nl_message[_ALIGNED_NL_HDR_LEN:]
 
     return nl_header, nl_body
 
 
+def parse_genl_body(nl_body):
+    """
+    Parse the body of a netlink message (see parse_nl_message) as genl
+
+    Useful when the netlink header has already been parsed, e.g. to check
+    for NLMSG_ERROR.
+    """
+    genl_header = GNLMessageHeader(*_GNL_HDR_S.unpack_from(nl_body, 0))
+    genl_body = nl_body[_ALIGNED_GNL_HDR_LEN:]
+
+    return genl_header, genl_body
+
+
 def parse_genl_message(genl_message):
-    nl_header, nl_body = parse_nl_message(genl_message)
+    genl_message = memoryview(genl_message)
 
-    genl_header_bytes = nl_body[:GNL_HEADER_LEN]
-    genl_header = GNLMessageHeader(*struct.unpack(GNL_HEADER_FMT,
-                                                  genl_header_bytes))
-    genl_body = nl_body[align(GNL_HEADER_LEN):]
+    (length, mtype, flags, seq, port,
+     cmd, version, reserved) = _NL_GNL_HDR_S.unpack_from(genl_message, 0)
+    nl_header = NLMessageHeader(length, mtype, flags, seq, port)
+    genl_header = GNLMessageHeader(cmd, version, reserved)
+    genl_body = genl_message[_NL_GNL_HDR_S.size:length]
 
     return nl_header, genl_header, genl_body
 
 
 def parse_nl_error(data):
-    error_fmt = "@i"
-    error = struct.unpack(error_fmt, data[0:struct.calcsize(error_fmt)])
-    return error[0]
+    return _ERR_S.unpack_from(data, 0)[0]
 
 
-def parse_generic_attributes(data):
-    index = 0
+def iter_generic_attributes(data):
+    """
+    Iterate over the netlink attributes in ``data``
 
-    attrib_hdr_fmt = "@HH"
-    attrib_hdr_len = struct.calcsize(attrib_hdr_fmt)
-    padded_attrib_hdr_len = align(attrib_hdr_len)
-
-    attributes = []
+    This yields plain ``(length, atype, data)`` tuples, which are much cheaper
+    to create than GNLAttributes. The attribute payloads are memoryviews into
+    ``data``. Schemata that hand payloads back to the user are responsible for
+    converting them to bytes.
+    """
+    data = memoryview(data)
+    index = 0
 
     while index < len(data):
-        nla_len, nla_type = struct.unpack(
-            attrib_hdr_fmt, data[index:index + attrib_hdr_len])
+        nla_len, nla_type = _NLA_HDR_S.unpack_from(data, index)
 
-        nla_data = data[index + padded_attrib_hdr_len:index + nla_len]
+        nla_data = data[index + _ALIGNED_NLA_HDR_LEN:index + nla_len]
 
-        index += align(nla_len)
+        index += (nla_len + 3) & ~3
         assert nla_len
 
-        attributes.append(GNLAttribute(nla_len, nla_type, nla_data))
+        yield nla_len, nla_type, nla_data
 
-    return attributes
+
+def parse_generic_attributes(data):
+    return [GNLAttribute(*a) for a in iter_generic_attributes(data)]
+
+
+def make_netlink_socket(groups=0, nonblocking=False):
+    """
+    Create a bound generic netlink socket
+
+    ``groups`` is a bitmask of multicast groups to bind to. If ``nonblocking``
+    is set, receives raise BlockingIOError instead of waiting for data, so
+    only use batch_recv_nl once the socket is known to be readable.
+    """
+    sock_type = socket.SOCK_RAW | socket.SOCK_CLOEXEC
+    if nonblocking:
+        sock_type |= socket.SOCK_NONBLOCK
+
+    sock = socket.socket(socket.AF_NETLINK, sock_type, NETLINK_GENERIC)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, NL_SOCKET_BUFSIZE)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, NL_SOCKET_BUFSIZE)
+        sock.bind((0, groups))
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+def recv_nl_datagram(sock):
+    """
+    Receive a single datagram from a netlink socket, however big it is
+
+    Peeks at the next datagram to find its full length, then receives exactly
+    that much, so a large reply can't be truncated and a small one doesn't
+    need a large buffer. Raises NetlinkError if the datagram is too short to
+    hold a netlink message; it's still taken off the socket.
+    """
+    size = sock.recv_into(bytearray(1), 1, socket.MSG_PEEK | socket.MSG_TRUNC)
+    # Python skips the syscall for a zero-length recv, which would leave an
+    # empty datagram at the head of the queue forever.
+    data = sock.recv(max(size, 1))
+    if len(data) < NL_HEADER_LEN:
+        raise NetlinkError("Netlink datagram too short ({} bytes)"
+                           .format(len(data)))
+    return data
+
+
+def recv_nl_response(sock):
+    """
+    Receive the netlink messages making up the response to a request
+
+    Reads from ``sock`` until the response is complete, i.e. until a message
+    without NLM_F_MULTI is received, or until the NLMSG_DONE that terminates
+    a multi-part response. Returns a list of the messages received (not
+    including the NLMSG_DONE), each as bytes. Raises NetlinkError if the
+    NLMSG_DONE carries an error code.
+    """
+    messages = []
+
+    while True:
+        datagram = recv_nl_datagram(sock)
+        view = memoryview(datagram)
+        index = 0
+        while index < len(datagram):
+            length, mtype, flags, _, _ = _NL_HDR_S.unpack_from(view, index)
+            if length < NL_HEADER_LEN:
+                raise NetlinkError("Invalid netlink message length %d"
+                                   % length)
+            if mtype == NLMSG_DONE:
+                # The kernel reports errors that end a dump early here
+                if length >= NL_HEADER_LEN + _ERR_S.size:
+                    error = abs(parse_nl_error(view[index + NL_HEADER_LEN:]))
+                    if error:
+                        raise NetlinkError(
+                            "Dump failed: %s [%s]"
+                            % (os.strerror(error),
+                               errno.errorcode.get(error, error)))
+                return messages
+
+            if index == 0 and length == len(datagram):
+                # Common case of one message per datagram; no need to copy
+                messages.append(datagram)
+            else:
+                messages.append(bytes(view[index:index + length]))
+            if not flags & NLM_F_MULTI:
+                return messages
+
+            index += align(length)
+
+
+def batch_recv_nl(sock, max_msgs=64):
+    """
+    Receive all the datagrams currently queued on a netlink socket
+
+    Blocks until at least one datagram is available, then keeps receiving
+    without blocking until the socket's queue is empty or ``max_msgs``
+    datagrams have been read. This is intended for sockets subscribed to
+    multicast groups, where events can arrive in bursts. Returns a list of the
+    datagrams, each as bytes.
+
+    Datagrams that don't fit in NL_RECV_BUFSIZE bytes can't be recovered once
+    they've been received. If the first one is too big, NetlinkError is
+    raised. Later ones are dropped with a warning, so that the datagrams
+    already received aren't lost.
+    """
+    buf = bytearray(NL_RECV_BUFSIZE)
+    view = memoryview(buf)
+
+    def recv(flags):
+        # With MSG_TRUNC the full length of the datagram is returned even if
+        # it didn't fit in the buffer
+        nbytes = sock.recv_into(buf, 0, flags | socket.MSG_TRUNC)
+        if nbytes > len(buf):
+            raise NetlinkError("Truncated {}-byte netlink datagram"
+                               .format(nbytes))
+        return bytes(view[:nbytes])
+
+    datagrams = [recv(0)]
+    received = 1
+
+    while received < max_msgs:
+        try:
+            datagram = recv(socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            break
+        except NetlinkError as e:
+            warnings.warn("Dropping datagram: {}".format(e))
+        else:
+            datagrams.append(datagram)
+        received += 1
+
+    return datagrams
 
 
 def wait_for_ack(sock):
-    data = sock.recv(4096)
+    data = recv_nl_datagram(sock)
     nl_header, nl_body = parse_nl_message(data)
     if nl_header.mtype != NLMSG_ERROR:
         raise NetlinkError("Invalid response to vendor command (%s)"
@@ -7,24 +7,69 @@ Tools for building and parsing netlink attributes with high-level Python
 
 import struct
 import warnings
-from collections import OrderedDict
+from collections.abc import Mapping
 from os.path import commonprefix
-try:
-    from collections.abc import Mapping  # Python 3
-except ImportError:
-    from collections import Mapping      # Python 2
 
-from .netlink import pad, NetlinkError, parse_generic_attributes
+from .netlink import (align, NetlinkError, iter_generic_attributes,
+                      NLA_HDR_FMT, NLA_HDR_LEN)
+
+
+# Maximum number of payloads each schema remembers from build() calls
+BUILD_CACHE_SIZE = 64
+# Types of kwargs values that build() results are cached for
+_CACHEABLE_TYPES = frozenset((int, bool, str, bytes))
 
 
 class NlAttrOmit(Exception):
     pass
 
 
+_NLA_HDR_S = struct.Struct(NLA_HDR_FMT)
+# Alignment padding, indexed by the number of bytes needed
+_PADDING = tuple(bytes(n) for n in range(4))
+
+
 def build_nlattr(attr_id, payload):
-    fmt = "=HH"
-    length = struct.calcsize(fmt) + len(payload)
-    return pad(struct.pack(fmt, length, attr_id) + payload)
+    out = bytearray()
+    _emit_attr(out, attr_id, payload)
+    return bytes(out)
+
+
+def _emit_attr(out, attr_id, payload):
+    """Append an attribute with its header and padding to bytearray ``out``"""
+    length = NLA_HDR_LEN + len(payload)
+
+    out += _NLA_HDR_S.pack(length, attr_id)
+    out += payload
+    padding = -length & 3
+    if padding:
+        out += _PADDING[padding]
+
+
+def _attr_emitter(attr_id, schema):
+    """
+    Get a function that appends an attribute to a bytearray
+
+    The returned function takes the output bytearray and the attribute's value.
+    Schemata use these to specialise their build path when they're
+    constructed: integer attributes have a fixed size, so the header and value
+    are packed with a single struct whose length field is known in advance.
+    """
+    # Only the stock class, so subclasses overriding build still get called
+    if type(schema) is NlAttrSchemaInt:
+        attr_struct = struct.Struct(NLA_HDR_FMT + schema.fmt[1:])
+        length = attr_struct.size
+        padding = bytes(align(length) - length)
+
+        def emit(out, val):
+            out += attr_struct.pack(length, attr_id, val)
+            if padding:
+                out += padding
+    else:
+        def emit(out, val):
+            _emit_attr(out, attr_id, schema.build(val))
+
+    return emit
 
 
 class NlAttrSet(Mapping):
@@ -37,7 +82,12 @@ class NlAttrSet(Mapping):
     names to dictionary keys. This is used, for example, so that the attributes
     in a netlink message might be accessed as either ``attrs["ATTR_FOO"]`` or
     ``attrs.foo``.
+
+    Schemata return instances of a subclass made by :func:`attr_set_class`,
+    which avoids the slow __getattr__ path for the attributes they know about.
     """
+    __slots__ = ("_values", "name_mapping")
+
     def __init__(self, values, name_mapping):
         self._values = values
         self.name_mapping = name_mapping
@@ -59,10 +109,42 @@ class NlAttrSet(Mapping):
                 name, list(self.name_mapping.keys())))
 
 
+def attr_set_class(name_mapping):
+    """
+    Create an NlAttrSet subclass with properties for the given Python names
+
+    Names that would shadow an existing NlAttrSet attribute (e.g. "keys") are
+    left to __getattr__, as before.
+    """
+    # Name the class after the attributes' common prefix, e.g.
+    # "NlAttrSet[NL80211_ATTR]", so reprs show which schema it came from.
+    # Without an explicit __module__, ABCMeta would report "abc".
+    qualname = "NlAttrSet"
+    prefix = commonprefix(list(name_mapping.values())).rstrip("_")
+    if prefix:
+        qualname += "[{}]".format(prefix)
+    namespace = {"__slots__": (), "__module__": __name__,
+                 "__qualname__": qualname}
+    for python_name, name in name_mapping.items():
+        if not hasattr(NlAttrSet, python_name):
+            namespace[python_name] = property(
+                lambda self, name=name: self._values[name])
+    return type("NlAttrSet", (NlAttrSet,), namespace)
+
+
+# Leaf schemata (ints, strings etc) are never modified after construction, so
+# from_spec hands out a single shared instance of each kind instead of creating
+# one per attribute.
+_shared_schemata = {}
+
+
 class NlAttrSchemaBase(object):
     @classmethod
     def from_spec(cls, spec, ids):
-        return cls()
+        try:
+            return _shared_schemata[cls]
+        except KeyError:
+            return _shared_schemata.setdefault(cls, cls())
 
 
 class NlAttrSchema(NlAttrSchemaBase):
@@ -88,9 +170,34 @@ class NlAttrSchema(NlAttrSchemaBase):
         # name_mapping is used to map between short Python names and full
         # netlink attribute ID names (e.g. "ifindex" -> "NL80211_ATTR_IFINDEX")
         self.name_mapping = name_mapping
-        self.required_attrs = required_attrs or []
+        self.required_attrs = frozenset(required_attrs or ())
         self.flag_attrs = [a for a, c in subattr_schemata.items()
                            if isinstance(c, NlAttrSchemaFlag)]
+        # Mappings for building, from full and Python attribute names to
+        # functions that append the attribute to a payload
+        self._name_to_emitter = {name: _attr_emitter(ids[name], schema)
+                                 for name, schema in subattr_schemata.items()}
+        self._py_name_to_emitter = {py_name: self._name_to_emitter[name]
+                                    for py_name, name
+                                    in (name_mapping or {}).items()}
+        self._required_py_names = frozenset(
+            py_name for py_name, name in (name_mapping or {}).items()
+            if name in self.required_attrs)
+        # Reverse mapping for parsing: numerical ID -> (name, parse method,
+        # schema). The bound method saves a lookup per parsed attribute.
+        self._id_to_entry = {}
+        for name, schema in subattr_schemata.items():
+            self._id_to_entry.setdefault(ids[name],
+                                         (name, schema.parse, schema))
+        # Numerical ID -> all names with that ID, to give hints about
+        # attributes that are missing from the schema
+        self._candidates_by_id = {}
+        for name, attr_id in ids.items():
+            self._candidates_by_id.setdefault(attr_id, []).append(name)
+        self._attr_set_cls = attr_set_class(name_mapping or {})
+        # Maps kwargs (with their value types) to payloads previously built
+        # from them
+        self._build_cache = {}
 
     @classmethod
     def from_spec(cls, spec, ids):
@@ -172,10 +279,10 @@ class NlAttrSchema(NlAttrSchemaBase):
         if not common_prefix.endswith("_"):
             common_prefix += "_"
 
-        # It would be weird for the ordering to matter semantically, but we use
-        # OrderedDict to keep stable ordering so that message content can be
-        # predicted byte-for-byte for testing and debugging.
-        subattr_schemata = OrderedDict()
+        # It would be weird for the ordering to matter semantically, but dicts
+        # keep insertion order, so message content can be predicted
+        # byte-for-byte for testing and debugging.
+        subattr_schemata = {}
         name_mapping = {}
         required_attrs = []
         for field_spec in spec:
@@ -207,39 +314,60 @@ class NlAttrSchema(NlAttrSchemaBase):
         if bool(_attr_values) == bool(kwargs):
             raise ValueError("Provide exactly one of _attr_values or kwargs")
 
-        if kwargs:
-            unknown_kwargs = set(kwargs).difference(self.name_mapping)
-            if unknown_kwargs:
-                raise ValueError("Unsupported kwargs {} (Supported: {})"
-                                 .format(unknown_kwargs,
-                                         self.name_mapping.keys()))
-            attr_values = {self.name_mapping[k]: v for k, v in kwargs.items()}
+        if not kwargs:
+            return self._build(_attr_values, self._name_to_emitter,
+                               self.required_attrs)
+
+        # Commands tend to be built over and over with the same simple kwargs
+        # (e.g. an ifindex), so cache the result for those. The types are
+        # part of the key, as 1, 1.0 and True are equal but needn't build
+        # the same way (or at all).
+        types = tuple(map(type, kwargs.values()))
+        if _CACHEABLE_TYPES.issuperset(types):
+            cache_key = (types, *kwargs.items())
+            try:
+                return self._build_cache[cache_key]
+            except KeyError:
+                pass
         else:
-            attr_values = _attr_values
+            cache_key = None
+
+        unknown_kwargs = kwargs.keys() - self.name_mapping.keys()
+        if unknown_kwargs:
+            raise ValueError("Unsupported kwargs {} (Supported: {})"
+                             .format(unknown_kwargs,
+                                     self.name_mapping.keys()))
+        payload = self._build(kwargs, self._py_name_to_emitter,
+                              self._required_py_names)
+
+        if (cache_key is not None and
+                len(self._build_cache) < BUILD_CACHE_SIZE):
+            self._build_cache[cache_key] = payload
+        return payload
 
-        payload = b""
+    def _build(self, attr_values, emitters, required):
+        # ``emitters`` maps the keys used in attr_values (either full attribute
+        # names or Python names) to the emitter function for the attribute.
+        # ``required`` is the set of keys that must be present.
+        payload = bytearray()
 
         # First check for unknown or attribute names or missing values
-        unknown_attrs = set(attr_values).difference(self.subattr_schemata)
+        unknown_attrs = attr_values.keys() - emitters.keys()
         if unknown_attrs:
             raise ValueError("Unknown attributes: {}".format(unknown_attrs))
-        missing_attrs = set(self.required_attrs).difference(attr_values)
+        missing_attrs = required - attr_values.keys()
         if missing_attrs:
             raise ValueError("Missing required attributes: {}"
                              .format(missing_attrs))
 
         # Now iterate over the known attributes and build the message up
-        for name, val in attr_values.items():
-            val = attr_values[name]
+        for key, val in attr_values.items():
             try:
-                attr_payload = self.subattr_schemata[name].build(val)
+                emitters[key](payload, val)
             except NlAttrOmit:
                 continue
 
-            attr_id = self.ids[name]
-            payload += build_nlattr(attr_id, attr_payload)
-
-        return payload
+        return bytes(payload)
 
     def parse(self, data):
         """
@@ -252,22 +380,20 @@ class NlAttrSchema(NlAttrSchemaBase):
         """
         attr_values = {}
 
-        for attr in parse_generic_attributes(data):
+        for _, atype, attr_data in iter_generic_attributes(data):
             # Find the name of the attribute with the given type
-            for attr_name, attr_type in self.subattr_schemata.items():
-                if attr.atype == self.ids[attr_name]:
-                    break
-            else:
-                msg = "Ignoring unknown attribute {}." .format(attr.atype)
-                candidates = [n for n, i in self.ids.items()
-                              if i == attr.atype]
+            entry = self._id_to_entry.get(atype)
+            if entry is None:
+                msg = "Ignoring unknown attribute {}." .format(atype)
+                candidates = self._candidates_by_id.get(atype)
                 if candidates:
                     msg += " Could be {}".format(", ".join(candidates))
                 warnings.warn(msg)
                 continue
+            attr_name, parse_attr, attr_type = entry
 
             try:
-                attr_values[attr_name] = attr_type.parse(attr.data)
+                attr_values[attr_name] = parse_attr(attr_data)
             except NetlinkError:
                 raise  # This exception hopefully has a useful message already
             except Exception as e:
@@ -277,7 +403,7 @@ class NlAttrSchema(NlAttrSchemaBase):
                     "Got '{}' while parsing attribute '{}' of type {}".format(
                         e, attr_name, type(attr_type).__name__))
 
-        missing_attrs = set(self.required_attrs).difference(attr_values)
+        missing_attrs = self.required_attrs - attr_values.keys()
         if missing_attrs:
             raise NetlinkError(
                 "Missing required attributes in parsed message: {}"
@@ -289,7 +415,7 @@ class NlAttrSchema(NlAttrSchemaBase):
             if attr_name not in attr_values:
                 attr_values[attr_name] = False
 
-        return NlAttrSet(attr_values, self.name_mapping)
+        return self._attr_set_cls(attr_values, self.name_mapping)
 
 
 schema_classes = {}
@@ -327,17 +453,23 @@ class NlAttrSchemaInt(NlAttrSchemaBase):
 
     def __init__(self, fmt):
         self.fmt = fmt
-        self.size = struct.calcsize(fmt)
+        self._struct = struct.Struct(fmt)
+        self.size = self._struct.size
 
     @classmethod
     def from_spec(cls, spec, ids):
-        return cls(int_type_to_fmt[spec["type"]])
+        key = (cls, spec["type"])
+        try:
+            return _shared_schemata[key]
+        except KeyError:
+            return _shared_schemata.setdefault(
+                key, cls(int_type_to_fmt[spec["type"]]))
 
     def build(self, val):
-        return struct.pack(self.fmt, val)
+        return self._struct.pack(val)
 
     def parse(self, data):
-        return struct.unpack(self.fmt, data)[0]
+        return self._struct.unpack(data)[0]
 
 
 @schema_class
@@ -346,14 +478,14 @@ class NlAttrSchemaStr(NlAttrSchemaBase):
     names = ["str"]
 
     def build(self, val):
+        # An embedded NUL would silently truncate the string on the other end
+        assert "\0" not in val
         return val.encode("ascii") + b'\0'
 
     def parse(self, data):
-        s = data.decode()
-        # Strip off trailing NUL
-        if s[-1] == '\0':
-            s = s[:-1]
-        return s
+        # Strip off trailing NUL (some strings are padded with several).
+        # Strings from the kernel aren't always ASCII, e.g. SSIDs.
+        return bytes(data).rstrip(b'\0').decode()
 
 
 @schema_class
@@ -365,7 +497,7 @@ class NlAttrSchemaBytes(NlAttrSchemaBase):
         return bytes(data)
 
     def parse(self, data):
-        return data
+        return bytes(data)
 
 
 @schema_class
@@ -394,11 +526,14 @@ class NlAttrSchemaFlagList(NlAttrSchemaBase):
 
     def build(self, data):
         # Data is a set of integer flags which will become attribute IDs
-        return b"".join(build_nlattr(attr_id=f, payload=b"") for f in data)
+        payload = bytearray()
+        for f in data:
+            _emit_attr(payload, f, b"")
+        return bytes(payload)
 
     def parse(self, data):
         # Just return a list of the attribute IDs
-        return list(a.atype for a in parse_generic_attributes(data))
+        return list(atype for _, atype, _ in iter_generic_attributes(data))
 
 
 class NlAttrSchemaCollection(NlAttrSchemaBase):
@@ -435,25 +570,23 @@ class NlAttrSchemaList(NlAttrSchemaCollection):
         self.ids = ids
 
     def build(self, attr_values):
-        payload = b""
+        payload = bytearray()
 
         for i, val in enumerate(attr_values):
             attr_payload = self.subelem_schema.build(val)
+            _emit_attr(payload, i + 1, attr_payload)
 
-            attr_id = i + 1
-            payload += build_nlattr(attr_id, attr_payload)
-
-        return payload
+        return bytes(payload)
 
     def parse(self, data):
-        attrs = parse_generic_attributes(data)
+        attrs = list(iter_generic_attributes(data))
         if not attrs:
             return []
 
         # Start with a list of Nones, in case the list is sparse.
-        ret = [None for i in range(max(a.atype for a in attrs))]
-        for attr in attrs:
-            ret[attr.atype - 1] = self.subelem_schema.parse(attr.data)
+        ret = [None for i in range(max(atype for _, atype, _ in attrs))]
+        for _, atype, attr_data in attrs:
+            ret[atype - 1] = self.subelem_schema.parse(attr_data)
         return ret
 
 
@@ -478,16 +611,33 @@ class NlAttrSchemaArray(NlAttrSchemaCollection):
                              "(schema object of type {} has no `size` attr)"
                              .format(type(subelem_schema).__name__))
 
+        # Arrays of integers are converted in one go with a repeat count in
+        # the struct format, e.g. "=3B" for three u8s. Subclasses may override
+        # build and parse, so they don't get this.
+        if type(subelem_schema) is NlAttrSchemaInt:
+            fmt = subelem_schema.fmt
+            self._int_fmt = fmt[0] + "{}" + fmt[1:]
+        else:
+            self._int_fmt = None
+
     def build(self, attr_values):
-        payload = b""
+        if self._int_fmt:
+            attr_values = tuple(attr_values)
+            return struct.pack(self._int_fmt.format(len(attr_values)),
+                               *attr_values)
+
+        payload = bytearray()
         for val in attr_values:
             payload += self.subelem_schema.build(val)
-        return payload
+        return bytes(payload)
 
     def parse(self, data):
-        ret = []
         elem_size = self.subelem_schema.size
-        while data:
-            ret.append(self.subelem_schema.parse(data[:elem_size]))
-            data = data[elem_size:]
-        return ret
+        if self._int_fmt:
+            return list(struct.unpack(
+                self._int_fmt.format(len(data) // elem_size), data))
+
+        parse_elem = self.subelem_schema.parse
+        data = memoryview(data)
+        return [parse_elem(data[offset:offset + elem_size])
+                for offset in range(0, len(data), elem_size)]
@@ -9,17 +9,13 @@ def hexdump_bufs(bufs):
 
     def to_hex_lines(buf):
         # First convert to a list of single-byte hex strings.
-        # Iterating over bytes in Python 2 is stupid hence use of ord.
-        hex_bytes = list("{:02x}".format(b) for b in buf)
+        hex_bytes = buf.hex(" ").split()
         # Pad out the shorter list with spaces
         hex_bytes += ["  "] * (longest_buf_len - len(buf))
 
-        hex_lines = []
-        while hex_bytes:
-            hex_lines.append(" ".join(hex_bytes[:4]))
-            hex_bytes = hex_bytes[4:]
-
-        return hex_lines
+        # Group into lines of 4 bytes
+        return [" ".join(hex_bytes[i:i + 4])
+                for i in range(0, len(hex_bytes), 4)]
 
     ret = ""
     for lines in zip(*(to_hex_lines(b) for b in bufs)):
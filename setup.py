@@ -6,6 +6,7 @@ def main():
         name="genl",
         version="0.1",
         packages=["genl"],
+        python_requires=">=3.8",
         classifiers=[
             "License :: OSI Approved :: GNU General Public License v2 (GPLv2)"
         ])
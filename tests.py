@@ -1,12 +1,9 @@
-from collections import OrderedDict
+import errno
+import socket
 import struct
-import sys
-from unittest import TestCase, SkipTest
-try:
-    from unittest.mock import Mock, patch
-except ImportError:
-    # Must be on Python 2, need to use 3rd party package
-    from mock import Mock, patch
+import warnings
+from unittest import TestCase
+from unittest.mock import Mock, patch
 
 from genl import (lookup_genl_family, CTRL_CMD_GETFAMILY, GenlFamilyInfo,
                   CTRL_ATTR_FAMILY_NAME, CTRL_ATTR_FAMILY_ID,
@@ -14,7 +11,9 @@ from genl import (lookup_genl_family, CTRL_CMD_GETFAMILY, GenlFamilyInfo,
                   CTRL_ATTR_MCAST_GRP_ID)
 
 from genl.netlink import (GENL_ID_CTRL, GNL_FAMILY_VERSION,
-                          NLM_F_REQUEST, pad, get_genl_message)
+                          NLM_F_REQUEST, NLM_F_MULTI, NLMSG_DONE,
+                          pad, get_genl_message, parse_nl_message,
+                          recv_nl_response, batch_recv_nl, NetlinkError)
 from genl.nl80211 import (nl80211_schema,
                           NL80211_ATTR_WIPHY_RETRY_SHORT,
                           NL80211_ATTR_NOACK_MAP, NL80211_ATTR_VENDOR_SUBCMD,
@@ -22,7 +21,7 @@ from genl.nl80211 import (nl80211_schema,
                           NL80211_ATTR_IFTYPE_EXT_CAPA, NL80211_ATTR_IFTYPE,
                           NL80211_ATTR_EXT_CAPA, NL80211_ATTR_KEY,
                           NL80211_KEY_DEFAULT, NL80211_KEY_IDX)
-from genl.nlattr import NlAttrSchema
+from genl.nlattr import NlAttrSchema, NlAttrSchemaArray, NlAttrSchemaInt
 
 
 # Helpers for creating Netlink attributes of various types
@@ -59,7 +58,7 @@ def nla_flag(attrib_id):
 
 
 def nla(attrib_id, data):
-    return _nla("@HH%ds" % len(data), attrib_id, data)
+    return _nla("=HH%ds" % len(data), attrib_id, data)
 
 
 def nla_str(attrib_id, data):
@@ -77,6 +76,22 @@ class SocketMock(Mock):
             messages.append(args[0])
         return messages
 
+    def set_received_messages(self, messages):
+        """Make the socket receive each of ``messages`` as a datagram"""
+        messages = list(messages)
+
+        def recv(bufsize, flags=0):
+            return messages.pop(0)[:bufsize]
+
+        def recv_into(buf, nbytes=0, flags=0):
+            msg = messages[0] if flags & socket.MSG_PEEK else messages.pop(0)
+            nbytes = min(nbytes or len(buf), len(msg))
+            buf[:nbytes] = msg[:nbytes]
+            return len(msg) if flags & socket.MSG_TRUNC else nbytes
+
+        self.recv.side_effect = recv
+        self.recv_into.side_effect = recv_into
+
 
 def assert_bufs_equal(buf1, buf2):
     """Asserter that provides a useful hexdump on failures"""
@@ -87,17 +102,13 @@ def assert_bufs_equal(buf1, buf2):
 
         def to_hex_lines(buf):
             # First convert to a list of single-byte hex strings.
-            # Iterating over bytes in Python 2 is stupid hence use of ord.
-            hex_bytes = list("{:02x}".format(b) for b in buf)
+            hex_bytes = buf.hex(" ").split()
             # Pad out the shorter list with spaces
             hex_bytes += ["  "] * (longest_buf_len - len(buf))
 
-            hex_lines = []
-            while hex_bytes:
-                hex_lines.append(" ".join(hex_bytes[:4]))
-                hex_bytes = hex_bytes[4:]
-
-            return hex_lines
+            # Group into lines of 4 bytes
+            return [" ".join(hex_bytes[i:i + 4])
+                    for i in range(0, len(hex_bytes), 4)]
 
         for buf1_line, buf2_line in zip(to_hex_lines(buf1),
                                         to_hex_lines(buf2)):
@@ -110,6 +121,9 @@ def assert_bufs_equal(buf1, buf2):
 
 @patch("socket.socket", new_callable=SocketMock)
 class TestGenlCtrl(TestCase):
+    def setUp(self):
+        lookup_genl_family.cache_clear()
+
     def test_lookup_genl_family(self, socket_mock):
         sock = socket_mock.return_value
 
@@ -123,11 +137,13 @@ class TestGenlCtrl(TestCase):
                     nla_str(CTRL_ATTR_MCAST_GRP_NAME, "bar") +
                     nla_u32(CTRL_ATTR_MCAST_GRP_ID, 2))))
 
-        sock.recv.side_effect = [msg]
+        sock.set_received_messages([msg])
 
         family = lookup_genl_family("dummy_family")
 
         [msg] = sock.get_sent_messages()
+        # Sequence numbers are allocated per message, so just copy that field
+        nl_header, _ = parse_nl_message(msg)
         assert_bufs_equal(
             msg,
             get_genl_message(
@@ -135,10 +151,101 @@ class TestGenlCtrl(TestCase):
                 flags=NLM_F_REQUEST,
                 cmd=CTRL_CMD_GETFAMILY,
                 version=GNL_FAMILY_VERSION,
+                seq=nl_header.seq,
                 payload=nla_str(CTRL_ATTR_FAMILY_NAME, "dummy_family")))
 
         self.assertEqual(family, GenlFamilyInfo(123, {"foo": 1, "bar": 2}))
 
+        # A second lookup should be served from the cache
+        self.assertIs(lookup_genl_family("dummy_family"), family)
+        self.assertEqual(len(sock.get_sent_messages()), 1)
+
+
+class TestNetlink(TestCase):
+    def test_recv_multipart(self):
+        sock = SocketMock()
+
+        msgs = [get_genl_message(nla_u32(1, i), flags=NLM_F_MULTI, cmd=i)
+                for i in range(3)]
+        done = get_genl_message(b"", mtype=NLMSG_DONE, flags=NLM_F_MULTI)
+        # Put the first two messages in one datagram
+        sock.set_received_messages([msgs[0] + msgs[1], msgs[2], done])
+
+        self.assertEqual(recv_nl_response(sock), msgs)
+
+    def test_recv_multipart_error(self):
+        sock = SocketMock()
+
+        msg = get_genl_message(nla_u32(1, 1), flags=NLM_F_MULTI)
+        # NLMSG_DONE has no genl header, just the error code after the
+        # netlink header
+        done = struct.pack("=IHHIIi", 20, NLMSG_DONE, NLM_F_MULTI, 0, 0,
+                           -errno.EINVAL)
+        sock.set_received_messages([msg, done])
+
+        with self.assertRaises(NetlinkError):
+            recv_nl_response(sock)
+
+    def test_recv_single(self):
+        sock = SocketMock()
+
+        msg = get_genl_message(nla_u32(1, 1))
+        sock.set_received_messages([msg])
+
+        self.assertEqual(recv_nl_response(sock), [msg])
+
+    def test_recv_short_datagram(self):
+        rx, tx = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            msg = get_genl_message(nla_u32(1, 1))
+            tx.send(b"")
+            tx.send(msg)
+
+            # The empty datagram is rejected but doesn't block the queue
+            with self.assertRaises(NetlinkError):
+                recv_nl_response(rx)
+            self.assertEqual(recv_nl_response(rx), [msg])
+        finally:
+            rx.close()
+            tx.close()
+
+    def test_batch_recv(self):
+        # Use a real datagram socket to check the non-blocking drain
+        rx, tx = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            msgs = [get_genl_message(nla_u32(1, i)) for i in range(5)]
+            for msg in msgs:
+                tx.send(msg)
+
+            self.assertEqual(batch_recv_nl(rx, max_msgs=3), msgs[:3])
+            self.assertEqual(batch_recv_nl(rx), msgs[3:])
+        finally:
+            rx.close()
+            tx.close()
+
+    @patch("genl.netlink.NL_RECV_BUFSIZE", 32)
+    def test_batch_recv_truncated(self):
+        rx, tx = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            small = get_genl_message(nla_u32(1, 1))
+            big = get_genl_message(nla_u32(1, 1) + nla_u32(2, 2))
+
+            tx.send(big)
+            with self.assertRaises(NetlinkError):
+                batch_recv_nl(rx)
+
+            # Once some datagrams have been received, a truncated one is
+            # dropped rather than losing them
+            for msg in (small, big, small):
+                tx.send(msg)
+            with warnings.catch_warnings(record=True) as w:
+                warnings.simplefilter("always")
+                self.assertEqual(batch_recv_nl(rx), [small, small])
+            self.assertEqual(len(w), 1)
+        finally:
+            rx.close()
+            tx.close()
+
 
 class TestNl80211(TestCase):
     # Here's a (nonsensical) nl80211 message payload trying to hit as many
@@ -163,24 +270,28 @@ class TestNl80211(TestCase):
 
     # Here's a dictionary expressing the attributes that should equate to the
     # buffer above
-    test_attrs = OrderedDict([
-        ("NL80211_ATTR_WIPHY_RETRY_SHORT", 1),
-        ("NL80211_ATTR_WIPHY_RETRY_SHORT", 1),
-        ("NL80211_ATTR_NOACK_MAP", 2),
-        ("NL80211_ATTR_VENDOR_SUBCMD", 3),
-        ("NL80211_ATTR_WDEV", 4),
-        ("NL80211_ATTR_STA_SUPPORTED_RATES", [5, 6, 7]),
-
-        ("NL80211_ATTR_IFTYPE_EXT_CAPA", [
-            OrderedDict([
-                ("NL80211_ATTR_IFTYPE", 8),
-                ("NL80211_ATTR_EXT_CAPA", b"\x09")]),
-            OrderedDict([
-                ("NL80211_ATTR_IFTYPE", 10),
-                ("NL80211_ATTR_EXT_CAPA", b"\x0b")])]),
-        ("NL80211_ATTR_KEY", OrderedDict([
-            ("NL80211_KEY_DEFAULT", True),
-            ("NL80211_KEY_IDX", 13)]))])
+    test_attrs = {
+        "NL80211_ATTR_WIPHY_RETRY_SHORT": 1,
+        "NL80211_ATTR_NOACK_MAP": 2,
+        "NL80211_ATTR_VENDOR_SUBCMD": 3,
+        "NL80211_ATTR_WDEV": 4,
+        "NL80211_ATTR_STA_SUPPORTED_RATES": [5, 6, 7],
+
+        "NL80211_ATTR_IFTYPE_EXT_CAPA": [
+            {
+                "NL80211_ATTR_IFTYPE": 8,
+                "NL80211_ATTR_EXT_CAPA": b"\x09",
+            },
+            {
+                "NL80211_ATTR_IFTYPE": 10,
+                "NL80211_ATTR_EXT_CAPA": b"\x0b",
+            },
+        ],
+        "NL80211_ATTR_KEY": {
+            "NL80211_KEY_DEFAULT": True,
+            "NL80211_KEY_IDX": 13,
+        },
+    }
 
     def test_build_kwargs(self):
         buf = nl80211_schema.build(
@@ -195,13 +306,6 @@ class TestNl80211(TestCase):
             ],
             key={"NL80211_KEY_DEFAULT": True, "NL80211_KEY_IDX": 13})
 
-        # Can't guarantee the order will be preserved on older Pythons
-        # https://docs.python.org/3/whatsnew/3.6.html#whatsnew36-pep468
-        # (We still built the message anyway, at least we know it didn't crash)
-        if sys.version_info < (3, 6):
-            raise SkipTest(
-                "Here's a shilling, young fellow! Get yourself a new Python")
-
         assert_bufs_equal(buf, self.test_buf)
 
     def test_build_dict(self):
@@ -298,3 +402,107 @@ class TestNlAttrSchema(TestCase):
         self.assertEqual(
             schema.parse(nla(ids["ATTR_FOO"], nla_flag(2) + nla_flag(3))).foo,
             [2, 3])
+
+    def test_build_cache(self):
+        ids = {"ATTR_FOO": 1, "ATTR_BAR": 2}
+        schema = NlAttrSchema.from_spec([
+            {"name": "ATTR_FOO", "type": "u32"},
+            {"name": "ATTR_BAR", "type": "array", "subelem_type": "u8"},
+        ], ids)
+
+        buf = schema.build(foo=1)
+        self.assertEqual(buf, nla_u32(1, 1))
+        self.assertIs(schema.build(foo=1), buf)
+        self.assertEqual(schema.build(foo=2), nla_u32(1, 2))
+
+        # Other types of value just skip the cache
+        self.assertEqual(schema.build(bar=[1, 2, 3, 4]),
+                         nla(2, b"\x01\x02\x03\x04"))
+        # Equal values of other types don't hit the cached payload
+        with self.assertRaises(struct.error):
+            schema.build(foo=1.0)
+
+    def test_int_subclass(self):
+        # Subclasses of the int schema don't get its fast paths, which would
+        # bypass their own build and parse
+        class EnumSchema(NlAttrSchemaInt):
+            values = ["zero", "one", "two"]
+
+            def build(self, val):
+                return super().build(self.values.index(val))
+
+            def parse(self, data):
+                return self.values[super().parse(data)]
+
+        enum_schema = EnumSchema("=B")
+        schema = NlAttrSchema(
+            {"ATTR_FOO": enum_schema,
+             "ATTR_BAR": NlAttrSchemaArray(enum_schema, {})},
+            {"ATTR_FOO": 1, "ATTR_BAR": 2},
+            name_mapping={"foo": "ATTR_FOO", "bar": "ATTR_BAR"})
+
+        self.assertEqual(schema.build(foo="two"), nla_u8(1, 2))
+        self.assertEqual(schema.parse(nla_u8(1, 2)).foo, "two")
+        buf = nla(2, b"\x01\x02")
+        self.assertEqual(schema.build(bar=("one", "two")), buf)
+        self.assertEqual(schema.parse(buf).bar, ["one", "two"])
+
+    def test_unknown_attr(self):
+        ids = {"ATTR_FOO": 1, "ATTR_BAR": 2}
+        schema = NlAttrSchema.from_spec([
+            {"name": "ATTR_FOO", "type": "u32"},
+        ], ids)
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            attrs = schema.parse(nla_u32(2, 5) + nla_u32(1, 6))
+
+        self.assertEqual(dict(attrs), {"ATTR_FOO": 6})
+        [warning] = caught
+        self.assertIn("Could be ATTR_BAR", str(warning.message))
+
+    def test_required(self):
+        ids = {"ATTR_FOO": 1, "ATTR_BAR": 2}
+        schema = NlAttrSchema.from_spec([
+            {"name": "ATTR_FOO", "type": "u32", "required": True},
+            {"name": "ATTR_BAR", "type": "u32"},
+        ], ids)
+
+        self.assertEqual(schema.build(foo=1), nla_u32(1, 1))
+        self.assertEqual(schema.build({"ATTR_FOO": 1}), nla_u32(1, 1))
+        with self.assertRaises(ValueError):
+            schema.build(bar=1)
+        with self.assertRaises(ValueError):
+            schema.build({"ATTR_BAR": 1})
+        with self.assertRaises(ValueError):
+            schema.build(baz=1)
+
+    def test_attr_access(self):
+        ids = {"ATTR_FOO": 1, "ATTR_KEYS": 2}
+        schema = NlAttrSchema.from_spec([
+            {"name": "ATTR_FOO", "type": "u32"},
+            {"name": "ATTR_KEYS", "type": "u32"},
+        ], ids)
+
+        attrs = schema.parse(nla_u32(1, 1) + nla_u32(2, 2))
+        self.assertEqual(attrs.foo, 1)
+        # Python names that clash with Mapping methods don't hide them
+        self.assertEqual(dict(attrs), {"ATTR_FOO": 1, "ATTR_KEYS": 2})
+        with self.assertRaises(AttributeError):
+            attrs.bar
+        with self.assertRaises(KeyError):
+            schema.parse(nla_u32(2, 2)).foo
+        self.assertEqual(type(attrs).__module__, "genl.nlattr")
+        self.assertEqual(type(attrs).__qualname__, "NlAttrSet[ATTR]")
+
+    def test_str(self):
+        ids = {"ATTR_SSID": 1}
+        schema = NlAttrSchema.from_spec([
+            {"name": "ATTR_SSID", "type": "str", "python_name": "ssid"},
+        ], ids)
+
+        self.assertEqual(schema.build(ssid="foo"), nla_str(1, "foo"))
+        self.assertEqual(schema.parse(nla_str(1, "foo")).ssid, "foo")
+        # Strings from the kernel can be UTF-8, and padded with several NULs
+        self.assertEqual(schema.parse(nla(1, "Café".encode() + b"\0\0")).ssid,
+                         "Café")